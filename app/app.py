@@ -1,125 +1,586 @@
 import os
+import re
+import mimetypes
+import sys
+import signal
 import sqlite3
 import secrets
+import atexit
+import hashlib
+import itertools
+import queue
+import random
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from functools import wraps
-from flask import Flask, render_template, request, redirect, url_for, make_response, send_from_directory, jsonify
-import bcrypt
-import qrcode
-import io
-import base64
+from functools import lru_cache, wraps
+from urllib.parse import quote
+from flask import Flask, abort, g, render_template, request, redirect, url_for, make_response, send_from_directory, jsonify
+from werkzeug.security import safe_join
+import segno
 
 app = Flask(__name__)
-app.config['DATABASE'] = 'database.db'
+# Kept in its own directory so the WAL (-wal/-shm) files sit next to it wherever it is mounted
+app.config['DATABASE'] = os.environ.get('DATABASE', 'data/database.db')
 app.config['VIDEO_FOLDER'] = 'videos'
+app.config['VIDEO_MAX_AGE'] = 86400  # 1 day; clients revalidate with ETag afterwards
+# Let a front-end server stream file bodies (X-Sendfile) instead of Python
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
+# Or let nginx stream them (X-Accel-Redirect) from an internal location at this prefix
+app.config['ACCEL_REDIRECT_PREFIX'] = os.environ.get('ACCEL_REDIRECT_PREFIX', '')
 app.config['SESSION_EXPIRY_HOURS'] = 72  # 3 days
 app.config['CASHOUT_TOKEN_EXPIRY_MINUTES'] = 5
+# bcrypt cost factor; each +1 doubles hashing time. 10 keeps a login around 50-100ms.
+# Lower it (minimum 4) only for throwaway test environments.
+app.config['BCRYPT_ROUNDS'] = int(os.environ.get('BCRYPT_ROUNDS', 10))
+app.config['DB_POOL_SIZE'] = 8
+# Bump when init_db() gains new tables, indexes or data conversions
+app.config['SCHEMA_VERSION'] = 6
+app.config['SESSION_CACHE_SIZE'] = 1024
+app.config['SESSION_CACHE_SECONDS'] = 60
+# Fraction of logins that also delete expired sessions
+app.config['SESSION_SWEEP_PROBABILITY'] = 0.01
+# Fraction of cashout QR requests that also delete used/expired cashout tokens
+app.config['CASHOUT_SWEEP_PROBABILITY'] = 0.05
+app.config['LOGIN_CACHE_SIZE'] = 128
+app.config['LOGIN_CACHE_SECONDS'] = 30
+app.config['PAGE_CACHE_SIZE'] = 256
+app.config['PAGE_CACHE_SECONDS'] = 3600
+app.config['CASHOUT_QR_CACHE_SIZE'] = 256
+app.config['STATUS_CACHE_SIZE'] = 256
+app.config['STATUS_CACHE_SECONDS'] = 30  # bounds staleness from edits made outside the app (init_db.py)
+app.config['SCAN_CACHE_SIZE'] = 1024
+app.config['SCAN_CACHE_SECONDS'] = 30  # same bound as the status cache
+
+# In-process caches
+class TTLCache:
+    """Thread-safe LRU mapping whose entries expire after a per-entry TTL"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value, or None if it is missing or expired"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires <= now:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        """Store a value for ttl seconds, evicting the least recently used entry when full"""
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        """Drop a single entry if present"""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def pop_if(self, predicate):
+        """Drop every entry whose value satisfies predicate"""
+        with self._lock:
+            for key in [k for k, (v, _) in self._data.items() if predicate(v)]:
+                del self._data[key]
+
+    def pop_values(self, value):
+        """Drop every entry holding the given value"""
+        self.pop_if(lambda v: v == value)
+
+# Session token -> (user_id, is_admin) for recently validated sessions
+_session_cache = TTLCache(app.config['SESSION_CACHE_SIZE'])
+# Bumped whenever cached sessions are dropped, so a lookup that read the database
+# before the drop doesn't put the stale row back into the cache
+_session_generation = 0
+_session_lock = threading.Lock()
+
+# (username, sha256 of password) -> user_id for recently verified logins,
+# so quick re-submits skip bcrypt. Only the digest is held, never the password.
+_login_cache = TTLCache(app.config['LOGIN_CACHE_SIZE'])
+
+# (template, context) -> rendered HTML for pages that are identical for
+# everyone given the same context
+_page_cache = TTLCache(app.config['PAGE_CACHE_SIZE'])
+
+# (user_id, host URL) -> (token, QR data URI) for the user's live cashout token,
+# so re-opening the cashout QR reuses it instead of minting and encoding a new one
+_cashout_qr_cache = TTLCache(app.config['CASHOUT_QR_CACHE_SIZE'])
+
+# (user_id, videos version, user version, is_admin, gack_coin) -> rendered status page
+_status_cache = TTLCache(app.config['STATUS_CACHE_SIZE'])
+
+# (scan_code, videos version) -> video_id for known scan codes, and
+# (user_id, video_id, user version) -> True once that user has found the video,
+# so repeat scans of the same code skip the database entirely
+_scan_code_cache = TTLCache(app.config['SCAN_CACHE_SIZE'])
+_found_cache = TTLCache(app.config['SCAN_CACHE_SIZE'])
+
+# Version counters that key the status, scan code and found caches. Bumping one makes every older
+# cache entry unreachable, so writers never have to find and delete entries.
+_versions_lock = threading.Lock()
+_videos_version = 0
+_user_versions = {}
+
+def bump_videos_version():
+    """Invalidate cached status data for all users after a videos change"""
+    global _videos_version
+    with _versions_lock:
+        _videos_version += 1
+
+def bump_user_version(user_id):
+    """Invalidate cached status data for one user after their progress changes; returns the new version"""
+    with _versions_lock:
+        version = _user_versions[user_id] = _user_versions.get(user_id, 0) + 1
+    return version
+
+# Shape of a valid scan code; anything else is rejected before touching the database.
+# init_db.py validates CLI-entered codes with the same pattern.
+SCAN_CODE_RE = re.compile(r'[A-Za-z0-9_-]{1,64}')
+
+# SQL for the per-request hot paths. sqlite3 keeps compiled statements per
+# connection keyed by SQL text, so with pooled connections these stay prepared
+# across requests.
+SQL_INSERT_SESSION = 'INSERT INTO sessions (token, user_id, expires_at) VALUES (?, ?, ?)'
+SQL_GET_SESSION = '''
+    SELECT s.user_id, s.expires_at, u.is_admin
+    FROM sessions s
+    JOIN users u ON u.id = s.user_id
+    WHERE s.token = ? AND s.expires_at > ?
+'''
+SQL_DELETE_SESSION = 'DELETE FROM sessions WHERE token = ?'
+SQL_DELETE_EXPIRED_SESSIONS = 'DELETE FROM sessions WHERE expires_at <= ?'
+SQL_GET_IS_ADMIN = 'SELECT is_admin FROM users WHERE id = ?'
+SQL_GET_LOGIN = 'SELECT id, password_hash FROM users WHERE username = ?'
+# Only replaces the hash that was just verified, never one an admin reset in the meantime
+SQL_UPDATE_PASSWORD_HASH = 'UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?'
+SQL_INSERT_USER = 'INSERT OR IGNORE INTO users (username, password_hash, is_admin) VALUES (?, ?, ?)'
+SQL_MARK_INTRO_SEEN = 'UPDATE users SET seen_intro = 1 WHERE id = ?'
+SQL_GET_GACK_COIN = 'SELECT gack_coin FROM users WHERE id = ?'
+SQL_GET_USER = 'SELECT id, is_admin, seen_intro, gack_coin FROM users WHERE id = ?'
+SQL_STATUS = '''
+    SELECT
+        v.id,
+        v.title,
+        v.hint,
+        v.is_bonus,
+        f.found_at,
+        u.unlocked_at,
+        COUNT(*) OVER evidence AS total_count,
+        COUNT(f.found_at) OVER evidence AS found_count,
+        COUNT(u.unlocked_at) OVER evidence AS unlocked_count
+    FROM videos v
+    LEFT JOIN found f ON v.id = f.video_id AND f.user_id = ?
+    LEFT JOIN unlocks u ON v.id = u.video_id AND u.user_id = ?
+    WHERE v.is_bonus IN (0, 1)
+    WINDOW evidence AS (PARTITION BY v.is_bonus)
+    ORDER BY v.is_bonus, v.id
+'''
+SQL_GET_VIDEO_BY_SCAN_CODE = 'SELECT id FROM videos WHERE scan_code = ?'
+SQL_INSERT_FOUND = 'INSERT OR IGNORE INTO found (user_id, video_id) VALUES (?, ?)'
+SQL_GET_VIDEO_PROGRESS = '''
+    SELECT v.*, f.found_at, u.unlocked_at
+    FROM videos v
+    LEFT JOIN found f ON v.id = f.video_id AND f.user_id = ?
+    LEFT JOIN unlocks u ON v.id = u.video_id AND u.user_id = ?
+    WHERE v.id = ?
+'''
+SQL_GET_UNLOCK_CHECK = '''
+    SELECT v.keyword, v.is_bonus, u.unlocked_at
+    FROM videos v
+    LEFT JOIN unlocks u ON v.id = u.video_id AND u.user_id = ?
+    WHERE v.id = ?
+'''
+SQL_INSERT_UNLOCK = 'INSERT OR IGNORE INTO unlocks (user_id, video_id) VALUES (?, ?)'
+SQL_DELETE_STALE_CASHOUT_TOKENS = 'DELETE FROM cashout_tokens WHERE used = 1 OR expires_at < ?'
+SQL_INSERT_CASHOUT_TOKEN = 'INSERT INTO cashout_tokens (token, user_id, expires_at) VALUES (?, ?, ?)'
+SQL_RENEW_CASHOUT_TOKEN = 'UPDATE cashout_tokens SET expires_at = ? WHERE token = ? AND user_id = ? AND used = 0'
+SQL_GET_CASHOUT_TOKEN = 'SELECT user_id, expires_at, used FROM cashout_tokens WHERE token = ?'
+SQL_GET_CASHOUT_USER = 'SELECT username, gack_coin FROM users WHERE id = ?'
+SQL_SET_GACK_COIN = 'UPDATE users SET gack_coin = ? WHERE id = ?'
+SQL_USE_CASHOUT_TOKEN = 'UPDATE cashout_tokens SET used = 1 WHERE token = ?'
+
+# Statements an admin reset / delete runs for one user id, all inside a
+# single write_db() transaction so they share one commit
+SQL_RESET_USER = (
+    'DELETE FROM found WHERE user_id = ?',
+    'DELETE FROM unlocks WHERE user_id = ?',
+    'UPDATE users SET gack_coin = 0 WHERE id = ?',
+    'DELETE FROM cashout_tokens WHERE user_id = ?',
+)
+SQL_DELETE_USER = (
+    'DELETE FROM found WHERE user_id = ?',
+    'DELETE FROM unlocks WHERE user_id = ?',
+    'DELETE FROM sessions WHERE user_id = ?',
+    'DELETE FROM cashout_tokens WHERE user_id = ?',
+    'DELETE FROM users WHERE id = ?',
+)
+
+# One UPDATE per combination of fields the admin panel can edit, so each
+# variant is a fixed string that stays in the statement cache
+VIDEO_EDIT_FIELDS = ('title', 'scan_code', 'keyword', 'hint', 'filename')
+SQL_UPDATE_VIDEO = {
+    frozenset(fields): f"UPDATE videos SET {', '.join(f'{field} = ?' for field in fields)} WHERE id = ?"
+    for count in range(1, len(VIDEO_EDIT_FIELDS) + 1)
+    for fields in itertools.combinations(VIDEO_EDIT_FIELDS, count)
+}
 
 # Database helper functions
-def get_db_connection():
-    conn = sqlite3.connect(app.config['DATABASE'])
+# Connections are kept open and reused across requests so SQLite's page cache
+# survives between hits instead of being rebuilt on every connect. Reads use a
+# pool of read-only connections; all writes go through one writer connection,
+# so in WAL mode readers never wait on a write.
+_pool = queue.Queue(maxsize=app.config['DB_POOL_SIZE'])
+_write_lock = threading.Lock()
+_write_conn = None
+
+def _connect(readonly=False):
+    """Open and configure a new database connection"""
+    conn = sqlite3.connect(app.config['DATABASE'], check_same_thread=False, cached_statements=256)
     conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA cache_size=-20000')
+    conn.execute('PRAGMA mmap_size=268435456')
+    # Wait for a concurrent writer instead of failing with "database is locked"
+    conn.execute('PRAGMA busy_timeout=5000')
+    conn.execute('PRAGMA foreign_keys=ON')
+    if readonly:
+        conn.execute('PRAGMA query_only=ON')
     return conn
 
-def init_db():
-    """Initialize the database with required tables"""
+def get_db_connection():
+    """Take a read-only connection from the pool, opening a new one if none are idle"""
+    try:
+        return _pool.get_nowait()
+    except queue.Empty:
+        return _connect(readonly=True)
+
+def release(conn):
+    """Return a connection to the pool, discarding any uncommitted work"""
+    if conn.in_transaction:
+        conn.rollback()
+    try:
+        _pool.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+@contextmanager
+def db():
+    """Borrow a pooled read-only connection for the duration of a with-block"""
     conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Create users table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL
-        )
-    ''')
-
-    # Create sessions table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS sessions (
-            token TEXT PRIMARY KEY,
-            user_id INTEGER NOT NULL,
-            expires_at TIMESTAMP NOT NULL,
-            FOREIGN KEY (user_id) REFERENCES users(id)
-        )
-    ''')
-
-    # Create videos table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS videos (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            filename TEXT NOT NULL,
-            title TEXT NOT NULL,
-            keyword TEXT NOT NULL,
-            hint TEXT
-        )
-    ''')
-
-    # Create found table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS found (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            video_id INTEGER NOT NULL,
-            found_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(id),
-            FOREIGN KEY (video_id) REFERENCES videos(id),
-            UNIQUE(user_id, video_id)
-        )
-    ''')
-
-    # Create unlocks table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS unlocks (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            video_id INTEGER NOT NULL,
-            unlocked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(id),
-            FOREIGN KEY (video_id) REFERENCES videos(id),
-            UNIQUE(user_id, video_id)
-        )
-    ''')
-
-    conn.commit()
-    conn.close()
+    try:
+        yield conn
+    finally:
+        release(conn)
+
+@contextmanager
+def write_db():
+    """Hold the writer connection inside a BEGIN IMMEDIATE transaction for a with-block"""
+    global _write_conn
+    with _write_lock:
+        if _write_conn is None:
+            _write_conn = _connect()
+        conn = _write_conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+
+@atexit.register
+def close_pool():
+    """Close all idle pooled connections and the writer on shutdown"""
+    while True:
+        try:
+            _pool.get_nowait().close()
+        except queue.Empty:
+            break
+    with _write_lock:
+        if _write_conn is not None:
+            _write_conn.close()
+
+def init_db():
+    """Initialize the database with required tables (skipped once the schema is current)"""
+    with write_db() as conn:
+        if conn.execute('PRAGMA user_version').fetchone()[0] >= app.config['SCHEMA_VERSION']:
+            return
+
+        cursor = conn.cursor()
+
+        # Create users table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT UNIQUE NOT NULL,
+                password_hash TEXT NOT NULL,
+                is_admin INTEGER DEFAULT 0,
+                seen_intro INTEGER DEFAULT 0,
+                gack_coin INTEGER DEFAULT 0
+            )
+        ''')
+
+        # Create sessions table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sessions (
+                token TEXT PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                expires_at INTEGER NOT NULL,
+                FOREIGN KEY (user_id) REFERENCES users(id)
+            )
+        ''')
+        # Sessions from before the switch to unix seconds still hold timestamp strings
+        cursor.execute("""UPDATE sessions SET expires_at = CAST(strftime('%s', expires_at, 'utc') AS INTEGER)
+                          WHERE typeof(expires_at) = 'text'""")
+
+        # Create videos table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS videos (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                filename TEXT NOT NULL,
+                title TEXT NOT NULL,
+                keyword TEXT NOT NULL,
+                hint TEXT,
+                scan_code TEXT UNIQUE NOT NULL,
+                is_bonus INTEGER DEFAULT 0,
+                image_path TEXT,
+                description TEXT
+            )
+        ''')
+
+        # Create found table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS found (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                video_id INTEGER NOT NULL,
+                found_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(id),
+                FOREIGN KEY (video_id) REFERENCES videos(id),
+                UNIQUE(user_id, video_id)
+            )
+        ''')
+
+        # Create unlocks table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS unlocks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                video_id INTEGER NOT NULL,
+                unlocked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(id),
+                FOREIGN KEY (video_id) REFERENCES videos(id),
+                UNIQUE(user_id, video_id)
+            )
+        ''')
+
+        # Create cashout_tokens table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS cashout_tokens (
+                token TEXT PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                expires_at TIMESTAMP NOT NULL,
+                used INTEGER DEFAULT 0,
+                FOREIGN KEY (user_id) REFERENCES users(id)
+            )
+        ''')
+
+        # Scan codes must be unique, but databases migrated from before the column
+        # existed have no UNIQUE constraint; the index enforces it once duplicates are fixed
+        duplicates = conn.execute('''SELECT scan_code, group_concat(id, ', ') FROM videos
+                                     WHERE scan_code IS NOT NULL
+                                     GROUP BY scan_code HAVING count(*) > 1''').fetchall()
+        if duplicates:
+            listing = '; '.join(f"{code} (video IDs {ids})" for code, ids in duplicates)
+            raise RuntimeError(f"Scan codes used by more than one video: {listing}. "
+                               "Give each video its own code (init_db.py edit-video), then restart.")
+
+        # Create indexes for scan code lookups, session expiry checks, and
+        # per-user cleanup of sessions and cashout tokens. Per-user found/unlocks
+        # lookups use their UNIQUE(user_id, video_id) indexes; per-video ones
+        # get their own.
+        cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_videos_scan_code_unique ON videos(scan_code)')
+        cursor.execute('DROP INDEX IF EXISTS idx_videos_scan_code')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions(user_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_cashout_tokens_user ON cashout_tokens(user_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_found_video ON found(video_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_unlocks_video ON unlocks(video_id)')
+        cursor.execute('ANALYZE')
+
+        # Award 1 gack_coin whenever an unlock row is inserted
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_unlock_award_coin AFTER INSERT ON unlocks
+            BEGIN
+                UPDATE users SET gack_coin = gack_coin + 1 WHERE id = NEW.user_id;
+            END
+        ''')
+
+        cursor.execute(f"PRAGMA user_version = {app.config['SCHEMA_VERSION']}")
+        conn.commit()
     print("Database initialized successfully!")
 
+def render_cached(template, **context):
+    """render_template, memoized on the template name and context values"""
+    key = (template, tuple(sorted(context.items())))
+    html = _page_cache.get(key)
+    if html is None:
+        html = render_template(template, **context)
+        _page_cache.set(key, html, app.config['PAGE_CACHE_SECONDS'])
+    return html
+
+# Password helpers
+# bcrypt releases the GIL, so hashing runs on its own pool sized to the CPU
+# count. A burst of logins then queues for a core instead of oversubscribing
+# the machine and slowing every other request thread.
+_hash_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix='bcrypt')
+
+def hash_password(password):
+    """bcrypt hash a password at the configured cost"""
+    import bcrypt
+    salt = bcrypt.gensalt(rounds=app.config['BCRYPT_ROUNDS'])
+    return _hash_pool.submit(bcrypt.hashpw, password.encode('utf-8'), salt).result()
+
+def check_password(password, password_hash):
+    """Check a password against a stored bcrypt hash"""
+    import bcrypt
+    return _hash_pool.submit(bcrypt.checkpw, password.encode('utf-8'), password_hash).result()
+
+def needs_rehash(password_hash):
+    """True if a stored hash ($2b$<cost>$...) was made at a different cost"""
+    return int(password_hash[4:6]) != app.config['BCRYPT_ROUNDS']
+
+# Keyword helpers
+KEYWORD_STRIP_RE = re.compile(r'[^a-z0-9]')
+
+def normalize_keyword(text):
+    """Lowercase and remove all non-alphanumeric characters"""
+    return KEYWORD_STRIP_RE.sub('', text.lower())
+
+@lru_cache(maxsize=256)
+def normalize_stored_keyword(keyword):
+    """normalize_keyword for the handful of stored keywords, computed once each"""
+    return normalize_keyword(keyword)
+
+# File helpers
+def send_protected(folder, filename, max_age=None, **kwargs):
+    """send_from_directory, or hand the file to nginx via X-Accel-Redirect when configured"""
+    prefix = app.config['ACCEL_REDIRECT_PREFIX']
+    if not prefix:
+        return send_from_directory(folder, filename, max_age=max_age, **kwargs)
+
+    # Same traversal and existence checks send_from_directory would make
+    path = safe_join(os.path.join(app.root_path, folder), filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    response = make_response('')
+    response.mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    response.headers['X-Accel-Redirect'] = f"{prefix.rstrip('/')}/{folder}/{quote(filename)}"
+    if max_age is not None:
+        response.cache_control.max_age = max_age
+    return response
+
 # Authentication helpers
-def create_session(user_id):
-    """Create a new session token for a user"""
+def insert_session(conn, user_id):
+    """Add a session for a user in the caller's write transaction; returns (token, is_admin)"""
     token = secrets.token_urlsafe(32)
-    expires_at = datetime.now() + timedelta(hours=app.config['SESSION_EXPIRY_HOURS'])
+    now = int(time.time())
+    expires_at = now + app.config['SESSION_EXPIRY_HOURS'] * 3600
+
+    conn.execute(SQL_INSERT_SESSION, (token, user_id, expires_at))
+    # Occasionally clear out expired sessions so the table stays small
+    if random.random() < app.config['SESSION_SWEEP_PROBABILITY']:
+        conn.execute(SQL_DELETE_EXPIRED_SESSIONS, (now,))
+    user = conn.execute(SQL_GET_IS_ADMIN, (user_id,)).fetchone()
+    return token, user['is_admin'] if user else 0
+
+# Called while still holding the writer, so an admin toggle can't commit in
+# between and leave a stale flag behind
+def remember_session(token, user_id, is_admin):
+    """Cache a just-committed session so the redirect that follows skips the database"""
+    _session_cache.set(token, (user_id, is_admin), app.config['SESSION_CACHE_SECONDS'])
 
-    conn = get_db_connection()
-    conn.execute('INSERT INTO sessions (token, user_id, expires_at) VALUES (?, ?, ?)',
-                 (token, user_id, expires_at))
-    conn.commit()
-    conn.close()
+def create_session(user_id):
+    """Create a new session token for a user"""
+    with write_db() as conn:
+        token, is_admin = insert_session(conn, user_id)
+        conn.commit()
+        remember_session(token, user_id, is_admin)
 
     return token
 
-def get_user_from_session(token):
-    """Get user ID from session token if valid"""
+def get_session(token):
+    """Get (user_id, is_admin) for a session token, or None if invalid"""
     if not token:
         return None
 
-    conn = get_db_connection()
-    session = conn.execute(
-        'SELECT user_id FROM sessions WHERE token = ? AND expires_at > ?',
-        (token, datetime.now())
-    ).fetchone()
-    conn.close()
+    cached = _session_cache.get(token)
+    if cached is not None:
+        return cached
+
+    generation = _session_generation
+    now = int(time.time())
+    with db() as conn:
+        session = conn.execute(SQL_GET_SESSION, (token, now)).fetchone()
+
+    # A timestamp string that escaped conversion compares above every integer; treat it as expired
+    if not session or not isinstance(session['expires_at'], int):
+        return None
 
-    return session['user_id'] if session else None
+    # Never cache a session past its own expiry
+    ttl = min(app.config['SESSION_CACHE_SECONDS'], session['expires_at'] - now)
+    cached = (session['user_id'], session['is_admin'])
+    with _session_lock:
+        if generation == _session_generation:
+            _session_cache.set(token, cached, ttl)
+    return cached
+
+def get_user_from_session(token):
+    """Get user ID from session token if valid"""
+    session = get_session(token)
+    return session[0] if session else None
+
+def forget_user_sessions(user_id):
+    """Drop cached sessions for a user whose account just changed"""
+    global _session_generation
+    with _session_lock:
+        _session_generation += 1
+        _session_cache.pop_if(lambda session: session[0] == user_id)
 
 def delete_session(token):
     """Delete a session token"""
-    conn = get_db_connection()
-    conn.execute('DELETE FROM sessions WHERE token = ?', (token,))
-    conn.commit()
-    conn.close()
+    global _session_generation
+    with write_db() as conn:
+        conn.execute(SQL_DELETE_SESSION, (token,))
+        conn.commit()
+    # Only after the commit, so a concurrent lookup can't re-cache the deleted row
+    with _session_lock:
+        _session_generation += 1
+        _session_cache.pop(token)
+
+def current_user(user_id):
+    """Row for the logged-in user, fetched at most once per request"""
+    if 'user' not in g:
+        with db() as conn:
+            g.user = conn.execute(SQL_GET_USER, (user_id,)).fetchone()
+    return g.user
 
 def login_required(f):
     """Decorator to require login for routes"""
@@ -136,17 +597,12 @@ def admin_required(f):
     """Decorator to require admin access for routes"""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        token = request.cookies.get('session')
-        user_id = get_user_from_session(token)
-        if not user_id:
+        session = get_session(request.cookies.get('session'))
+        if not session:
             return redirect(url_for('login'))
 
-        # Check if user is admin
-        conn = get_db_connection()
-        user = conn.execute('SELECT is_admin FROM users WHERE id = ?', (user_id,)).fetchone()
-        conn.close()
-
-        if not user or not user['is_admin']:
+        user_id, is_admin = session
+        if not is_admin:
             return "Access denied - Admin only", 403
 
         return f(user_id, *args, **kwargs)
@@ -160,10 +616,7 @@ def index():
     user_id = get_user_from_session(token)
     if user_id:
         # Check if user has seen intro
-        conn = get_db_connection()
-        user = conn.execute('SELECT seen_intro FROM users WHERE id = ?', (user_id,)).fetchone()
-        conn.close()
-
+        user = current_user(user_id)
         if user and not user['seen_intro']:
             return redirect(url_for('intro'))
         return redirect(url_for('status'))
@@ -179,20 +632,40 @@ def login():
         if not username or not password:
             return render_template('login.html', error='Username and password are required')
 
-        conn = get_db_connection()
-        user = conn.execute('SELECT id, password_hash FROM users WHERE username = ?', (username,)).fetchone()
-        conn.close()
+        credential_key = (username, hashlib.sha256(password.encode('utf-8')).hexdigest())
+        user_id = _login_cache.get(credential_key)
+
+        if user_id is None:
+            with db() as conn:
+                user = conn.execute(SQL_GET_LOGIN, (username,)).fetchone()
+
+            if user and check_password(password, user['password_hash']):
+                user_id = user['id']
+                remember_login = True
+
+                # Move older hashes (e.g. the seeded accounts) to the configured cost
+                if needs_rehash(user['password_hash']):
+                    password_hash = hash_password(password)
+                    with write_db() as conn:
+                        cursor = conn.execute(SQL_UPDATE_PASSWORD_HASH,
+                                              (password_hash, user_id, user['password_hash']))
+                        conn.commit()
+                    # No row updated: the password was changed since it was checked
+                    remember_login = cursor.rowcount == 1
+
+                if remember_login:
+                    _login_cache.set(credential_key, user_id, app.config['LOGIN_CACHE_SECONDS'])
 
-        if user and bcrypt.checkpw(password.encode('utf-8'), user['password_hash']):
+        if user_id is not None:
             # Create session and set cookie
-            token = create_session(user['id'])
+            token = create_session(user_id)
             response = make_response(redirect(url_for('status')))
             response.set_cookie('session', token, httponly=True, samesite='Lax', max_age=app.config['SESSION_EXPIRY_HOURS']*3600)
             return response
         else:
             return render_template('login.html', error='Invalid username or password')
 
-    return render_template('login.html')
+    return render_cached('login.html')
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
@@ -216,30 +689,25 @@ def register():
             return render_template('register.html', error='Passwords do not match')
 
         # Create user
-        conn = get_db_connection()
-        password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+        password_hash = hash_password(password)
 
-        try:
-            conn.execute('INSERT INTO users (username, password_hash, is_admin) VALUES (?, ?, ?)',
-                        (username, password_hash, 0))
-            conn.commit()
-            conn.close()
-
-            # Auto-login after registration and redirect to intro
-            conn = get_db_connection()
-            user = conn.execute('SELECT id FROM users WHERE username = ?', (username,)).fetchone()
-            conn.close()
+        # Create the user and their session in one transaction, then
+        # auto-login and redirect to intro
+        with write_db() as conn:
+            cur = conn.execute(SQL_INSERT_USER, (username, password_hash, 0))
+            if not cur.rowcount:
+                return render_template('register.html', error='Username already exists')
 
-            token = create_session(user['id'])
-            response = make_response(redirect(url_for('intro')))
-            response.set_cookie('session', token, httponly=True, samesite='Lax', max_age=app.config['SESSION_EXPIRY_HOURS']*3600)
-            return response
+            new_user_id = cur.lastrowid
+            token, is_admin = insert_session(conn, new_user_id)
+            conn.commit()
+            remember_session(token, new_user_id, is_admin)
 
-        except sqlite3.IntegrityError:
-            conn.close()
-            return render_template('register.html', error='Username already exists')
+        response = make_response(redirect(url_for('intro')))
+        response.set_cookie('session', token, httponly=True, samesite='Lax', max_age=app.config['SESSION_EXPIRY_HOURS']*3600)
+        return response
 
-    return render_template('register.html')
+    return render_cached('register.html')
 
 @app.route('/logout')
 def logout():
@@ -256,96 +724,88 @@ def logout():
 @login_required
 def intro(user_id):
     """Intro/briefing page with mission video"""
-    conn = get_db_connection()
-    user = conn.execute('SELECT gack_coin FROM users WHERE id = ?', (user_id,)).fetchone()
-    conn.close()
+    user = current_user(user_id)
     gack_coin = user['gack_coin'] if user else 0
-    return render_template('intro.html', gack_coin=gack_coin)
+    return render_cached('intro.html', gack_coin=gack_coin)
 
 @app.route('/mark-intro-seen', methods=['POST'])
 @login_required
 def mark_intro_seen(user_id):
     """Mark that user has seen the intro"""
-    conn = get_db_connection()
-    conn.execute('UPDATE users SET seen_intro = 1 WHERE id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    with write_db() as conn:
+        conn.execute(SQL_MARK_INTRO_SEEN, (user_id,))
+        conn.commit()
     return jsonify({'success': True})
 
 @app.route('/status')
 @login_required
 def status(user_id):
     """Status page showing found, unlocked, and missing videos"""
-    conn = get_db_connection()
-
-    # Check if user is admin and get gack_coin
-    user = conn.execute('SELECT is_admin, gack_coin FROM users WHERE id = ?', (user_id,)).fetchone()
+    user = current_user(user_id)
     is_admin = user['is_admin'] if user else 0
     gack_coin = user['gack_coin'] if user else 0
 
-    # Get main evidence (is_bonus = 0)
-    main_videos = conn.execute('''
-        SELECT
-            v.id,
-            v.title,
-            v.hint,
-            f.found_at,
-            u.unlocked_at
-        FROM videos v
-        LEFT JOIN found f ON v.id = f.video_id AND f.user_id = ?
-        LEFT JOIN unlocks u ON v.id = u.video_id AND u.user_id = ?
-        WHERE v.is_bonus = 0
-        ORDER BY v.id
-    ''', (user_id, user_id)).fetchall()
-
-    # Get bonus evidence (is_bonus = 1)
-    bonus_videos = conn.execute('''
-        SELECT
-            v.id,
-            v.title,
-            v.hint,
-            f.found_at,
-            u.unlocked_at
-        FROM videos v
-        LEFT JOIN found f ON v.id = f.video_id AND f.user_id = ?
-        LEFT JOIN unlocks u ON v.id = u.video_id AND u.user_id = ?
-        WHERE v.is_bonus = 1
-        ORDER BY v.id
-    ''', (user_id, user_id)).fetchall()
-
-    conn.close()
-
-    # Convert to list of dicts and calculate counts (only for main evidence)
-    main_videos_list = [dict(video) for video in main_videos]
-    bonus_videos_list = [dict(video) for video in bonus_videos]
-
-    total_count = len(main_videos_list)
-    found_count = sum(1 for v in main_videos_list if v['found_at'])
-    unlocked_count = sum(1 for v in main_videos_list if v['unlocked_at'])
+    # The balance is part of the key because cashouts change it without
+    # touching the user's progress version
+    key = (user_id, _videos_version, _user_versions.get(user_id, 0), is_admin, gack_coin)
+    html = _status_cache.get(key)
+
+    if html is None:
+        with db() as conn:
+            progress = load_status_progress(conn, user_id)
+        html = render_template('status.html',
+                               is_admin=is_admin,
+                               gack_coin=gack_coin,
+                               **progress)
+        _status_cache.set(key, html, app.config['STATUS_CACHE_SECONDS'])
+
+    return html
+
+def load_status_progress(conn, user_id):
+    """Build the evidence lists, counts, and active hint shown on the status page"""
+    main_videos_list = []
+    bonus_videos_list = []
+    unfound_main_videos = []
+
+    # Split main and bonus evidence in one pass
+    # sqlite3.Row supports key access, so templates use the rows as-is
+    for video in conn.execute(SQL_STATUS, (user_id, user_id)):
+        if video['is_bonus']:
+            bonus_videos_list.append(video)
+            continue
+        main_videos_list.append(video)
+        if not video['found_at']:
+            unfound_main_videos.append(video)
+
+    # Counts are for main evidence only; SQLite computed them per partition on every row
+    if main_videos_list:
+        first = main_videos_list[0]
+        total_count, found_count, unlocked_count = first['total_count'], first['found_count'], first['unlocked_count']
+    else:
+        total_count = found_count = unlocked_count = 0
 
     # Check if all main videos are unlocked (cryptid identified)
     all_solved = (unlocked_count == total_count and total_count > 0)
 
     # Determine which single hint to show (for unfound main videos only)
-    unfound_main_videos = [v for v in main_videos_list if not v['found_at']]
     active_hint_id = None
     if unfound_main_videos:
-        # Use hash of user_id + sorted unfound IDs for deterministic selection
-        unfound_ids = tuple(sorted([v['id'] for v in unfound_main_videos]))
-        hash_seed = hash((user_id, unfound_ids))
+        # Use a blake2b digest of user_id + sorted unfound IDs for selection that
+        # stays the same across processes and Python versions
+        seed_key = b''.join(i.to_bytes(8, 'little') for i in (user_id, *(v['id'] for v in unfound_main_videos)))
+        hash_seed = int.from_bytes(hashlib.blake2b(seed_key, digest_size=8).digest(), 'little')
         selected_index = hash_seed % len(unfound_main_videos)
         active_hint_id = unfound_main_videos[selected_index]['id']
 
-    return render_template('status.html',
-                         videos=main_videos_list,
-                         bonus_videos=bonus_videos_list,
-                         total_count=total_count,
-                         found_count=found_count,
-                         unlocked_count=unlocked_count,
-                         is_admin=is_admin,
-                         all_solved=all_solved,
-                         gack_coin=gack_coin,
-                         active_hint_id=active_hint_id)
+    return {
+        'videos': main_videos_list,
+        'bonus_videos': bonus_videos_list,
+        'total_count': total_count,
+        'found_count': found_count,
+        'unlocked_count': unlocked_count,
+        'all_solved': all_solved,
+        'active_hint_id': active_hint_id,
+    }
 
 @app.route('/qr/<scan_code>')
 def qr_redirect(scan_code):
@@ -367,44 +827,50 @@ def qr_redirect(scan_code):
 @login_required
 def qrscan(user_id):
     """QR code scanning page"""
-    conn = get_db_connection()
-    user = conn.execute('SELECT gack_coin FROM users WHERE id = ?', (user_id,)).fetchone()
-    conn.close()
+    user = current_user(user_id)
     gack_coin = user['gack_coin'] if user else 0
-    return render_template('qrscan.html', gack_coin=gack_coin)
+    return render_cached('qrscan.html', gack_coin=gack_coin)
 
 @app.route('/verify-scan', methods=['POST'])
 @login_required
 def verify_scan(user_id):
     """Verify scanned code and mark video as found"""
-    scan_code = request.json.get('code', '').strip()
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        payload = {}
+    scan_code = str(payload.get('code') or '').strip()
 
     if not scan_code:
         return jsonify({'success': False, 'error': 'No scan code provided'}), 400
 
-    conn = get_db_connection()
+    if not SCAN_CODE_RE.fullmatch(scan_code):
+        return jsonify({'success': False, 'error': 'Invalid scan code'}), 404
 
     # Look up video by scan code
-    video = conn.execute('SELECT id, is_bonus FROM videos WHERE scan_code = ?', (scan_code,)).fetchone()
+    scan_key = (scan_code, _videos_version)
+    video_id = _scan_code_cache.get(scan_key)
+    if video_id is None:
+        with db() as conn:
+            video = conn.execute(SQL_GET_VIDEO_BY_SCAN_CODE, (scan_code,)).fetchone()
 
-    if not video:
-        conn.close()
-        return jsonify({'success': False, 'error': 'Invalid scan code'}), 404
+        if not video:
+            return jsonify({'success': False, 'error': 'Invalid scan code'}), 404
 
-    video_id = video['id']
-    is_bonus = video['is_bonus']
-    bonus_awarded = False
-
-    # Mark as found
-    try:
-        conn.execute('INSERT INTO found (user_id, video_id) VALUES (?, ?)', (user_id, video_id))
-        conn.commit()
+        video_id = video['id']
+        _scan_code_cache.set(scan_key, video_id, app.config['SCAN_CACHE_SECONDS'])
 
-    except sqlite3.IntegrityError:
-        # Already found, that's okay
-        pass
+    bonus_awarded = False
 
-    conn.close()
+    # Mark as found (already found is fine - the insert is simply ignored). The cache
+    # key uses the version read before the write or returned by our own bump, never a
+    # re-read one that an admin reset may have bumped in between.
+    user_version = _user_versions.get(user_id, 0)
+    if not _found_cache.get((user_id, video_id, user_version)):
+        with write_db() as conn:
+            if conn.execute(SQL_INSERT_FOUND, (user_id, video_id)).rowcount:
+                conn.commit()
+                user_version = bump_user_version(user_id)
+        _found_cache.set((user_id, video_id, user_version), True, app.config['SCAN_CACHE_SECONDS'])
 
     return jsonify({
         'success': True,
@@ -423,41 +889,28 @@ def video(user_id):
         # No ID provided - show no access
         return render_template('no_access.html', video_title='UNKNOWN')
 
-    conn = get_db_connection()
-
-    # Get video details
-    video_data = conn.execute('SELECT * FROM videos WHERE id = ?', (video_id,)).fetchone()
-
-    if not video_data:
-        conn.close()
-        # Invalid video ID - show no access
-        return render_template('no_access.html', video_title='INVALID ID')
+    with db() as conn:
+        # Get video details along with whether the user has found and unlocked it
+        video_data = conn.execute(SQL_GET_VIDEO_PROGRESS, (user_id, user_id, video_id)).fetchone()
 
-    # Check if user has found this video (scanned the QR code)
-    found = conn.execute('SELECT found_at FROM found WHERE user_id = ? AND video_id = ?',
-                        (user_id, video_id)).fetchone()
+        if not video_data:
+            # Invalid video ID - show no access
+            return render_template('no_access.html', video_title='INVALID ID')
 
-    if not found:
-        conn.close()
-        # User hasn't scanned the QR code - show no access
-        return render_template('no_access.html', video_title=video_data['title'])
-
-    # Check if unlocked
-    unlocked = conn.execute('SELECT unlocked_at FROM unlocks WHERE user_id = ? AND video_id = ?',
-                           (user_id, video_id)).fetchone()
+        if not video_data['found_at']:
+            # User hasn't scanned the QR code - show no access
+            return render_template('no_access.html', video_title=video_data['title'])
 
     # Get user's gack_coin count
-    user = conn.execute('SELECT gack_coin FROM users WHERE id = ?', (user_id,)).fetchone()
+    user = current_user(user_id)
     gack_coin = user['gack_coin'] if user else 0
 
-    conn.close()
-
     # Choose template based on bonus status
     template = 'bonus.html' if video_data['is_bonus'] else 'video.html'
 
     return render_template(template,
-                         video=dict(video_data),
-                         is_unlocked=bool(unlocked),
+                         video=video_data,
+                         is_unlocked=bool(video_data['unlocked_at']),
                          gack_coin=gack_coin)
 
 @app.route('/unlock', methods=['POST'])
@@ -470,75 +923,69 @@ def unlock(user_id):
     if not video_id or not keyword:
         return jsonify({'success': False, 'error': 'Invalid request'}), 400
 
-    conn = get_db_connection()
-
-    # Get video keyword and bonus status
-    video_data = conn.execute('SELECT keyword, is_bonus FROM videos WHERE id = ?', (video_id,)).fetchone()
+    with db() as conn:
+        # Get video keyword, bonus status, and any existing unlock
+        video_data = conn.execute(SQL_GET_UNLOCK_CHECK, (user_id, video_id)).fetchone()
 
     if not video_data:
-        conn.close()
         return jsonify({'success': False, 'error': 'Video not found'}), 404
 
     # Check keyword (case-insensitive, space-insensitive, special-character-insensitive)
-    # Special case: "*ANY*" accepts any non-empty answer
-    import re
-    def normalize_keyword(text):
-        # Remove all non-alphanumeric characters and convert to lowercase
-        return re.sub(r'[^a-z0-9]', '', text.lower())
-
-    keyword_matches = (video_data['keyword'] == '*ANY*' and keyword.strip() != '') or (normalize_keyword(keyword) == normalize_keyword(video_data['keyword']))
+    # Special case: "*ANY*" accepts any non-empty answer (keyword is stripped and non-empty here)
+    stored_keyword = video_data['keyword']
+    keyword_matches = stored_keyword == '*ANY*' or normalize_keyword(keyword) == normalize_stored_keyword(stored_keyword)
 
-    if keyword_matches:
-        # Mark as unlocked
-        try:
-            conn.execute('INSERT INTO unlocks (user_id, video_id) VALUES (?, ?)', (user_id, video_id))
-            # Increment gack_coin for first-time unlock
-            conn.execute('UPDATE users SET gack_coin = gack_coin + 1 WHERE id = ?', (user_id,))
-            conn.commit()
+    if not keyword_matches:
+        return jsonify({'success': False, 'error': 'Incorrect keyword'})
 
-            conn.close()
-            return jsonify({'success': True, 'message': 'Evidence unlocked successfully!'})
+    if video_data['unlocked_at']:
+        return jsonify({'success': True, 'message': 'Evidence already unlocked!'})
 
-        except sqlite3.IntegrityError:
-            conn.close()
+    with write_db() as conn:
+        # Mark as unlocked (the trg_unlock_award_coin trigger awards the
+        # gack_coin); a concurrent unlock may have won the race
+        if not conn.execute(SQL_INSERT_UNLOCK, (user_id, video_id)).rowcount:
             return jsonify({'success': True, 'message': 'Evidence already unlocked!'})
-    else:
-        conn.close()
-        return jsonify({'success': False, 'error': 'Incorrect keyword'})
+        conn.commit()
+    bump_user_version(user_id)
+
+    return jsonify({'success': True, 'message': 'Evidence unlocked successfully!'})
 
 @app.route('/videos/<path:filename>')
 @login_required
 def serve_video(user_id, filename):
     """Serve video files"""
-    return send_from_directory(app.config['VIDEO_FOLDER'], filename)
+    response = send_protected(app.config['VIDEO_FOLDER'], filename,
+                              conditional=True, max_age=app.config['VIDEO_MAX_AGE'])
+    # Videos sit behind login, so shared caches (e.g. the reverse proxy) must not keep them
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
 
 @app.route('/images/<path:filename>')
 @login_required
 def serve_image(user_id, filename):
     """Serve bonus evidence image files"""
-    return send_from_directory('images', filename)
+    return send_protected('images', filename)
 
 @app.route('/admin')
 @admin_required
 def admin(user_id):
     """Admin panel for managing videos and users"""
-    conn = get_db_connection()
-
-    # Get all videos
-    videos = conn.execute('SELECT * FROM videos ORDER BY id').fetchall()
+    with db() as conn:
+        # Get all videos
+        videos = conn.execute('SELECT * FROM videos ORDER BY id').fetchall()
 
-    # Get all users
-    users = conn.execute('SELECT id, username, is_admin FROM users ORDER BY id').fetchall()
+        # Get all users
+        users = conn.execute('SELECT id, username, is_admin FROM users ORDER BY id').fetchall()
 
     # Get gack_coin for current admin user
-    user = conn.execute('SELECT gack_coin FROM users WHERE id = ?', (user_id,)).fetchone()
+    user = current_user(user_id)
     gack_coin = user['gack_coin'] if user else 0
 
-    conn.close()
-
     return render_template('admin.html',
-                         videos=[dict(v) for v in videos],
-                         users=[dict(u) for u in users],
+                         videos=videos,
+                         users=users,
                          gack_coin=gack_coin)
 
 @app.route('/admin/edit-video', methods=['POST'])
@@ -546,51 +993,32 @@ def admin(user_id):
 def admin_edit_video(user_id):
     """Handle video edit from admin panel"""
     video_id = request.form.get('video_id', type=int)
-    title = request.form.get('title', '').strip()
-    scan_code = request.form.get('scan_code', '').strip()
-    keyword = request.form.get('keyword', '').strip()
-    hint = request.form.get('hint', '').strip()
-    filename = request.form.get('filename', '').strip()
+    values = {field: request.form.get(field, '').strip() for field in VIDEO_EDIT_FIELDS}
 
     if not video_id:
         return jsonify({'success': False, 'error': 'Video ID required'}), 400
 
-    conn = get_db_connection()
+    # Only update the fields that were provided
+    fields = [field for field in VIDEO_EDIT_FIELDS if values[field]]
 
-    # Build update query dynamically based on provided fields
-    updates = []
-    params = []
-
-    if title:
-        updates.append('title = ?')
-        params.append(title)
-    if scan_code:
-        updates.append('scan_code = ?')
-        params.append(scan_code)
-    if keyword:
-        updates.append('keyword = ?')
-        params.append(keyword)
-    if hint:
-        updates.append('hint = ?')
-        params.append(hint)
-    if filename:
-        updates.append('filename = ?')
-        params.append(filename)
-
-    if not updates:
+    if not fields:
         return jsonify({'success': False, 'error': 'No fields to update'}), 400
 
-    params.append(video_id)
-    query = f"UPDATE videos SET {', '.join(updates)} WHERE id = ?"
+    # A code the scanner would reject could never be found
+    if values['scan_code'] and not SCAN_CODE_RE.fullmatch(values['scan_code']):
+        return jsonify({'success': False, 'error': 'Scan code may only contain letters, digits, _ and - (max 64)'}), 400
 
-    try:
-        conn.execute(query, params)
-        conn.commit()
-        conn.close()
-        return jsonify({'success': True, 'message': 'Video updated successfully'})
-    except sqlite3.IntegrityError:
-        conn.close()
-        return jsonify({'success': False, 'error': 'Scan code must be unique'}), 400
+    query = SQL_UPDATE_VIDEO[frozenset(fields)]
+    params = [values[field] for field in fields] + [video_id]
+
+    with write_db() as conn:
+        try:
+            conn.execute(query, params)
+            conn.commit()
+            bump_videos_version()
+            return jsonify({'success': True, 'message': 'Video updated successfully'})
+        except sqlite3.IntegrityError:
+            return jsonify({'success': False, 'error': 'Scan code must be unique'}), 400
 
 @app.route('/admin/reset-password', methods=['POST'])
 @admin_required
@@ -602,20 +1030,22 @@ def admin_reset_password(user_id):
     if not username or not new_password:
         return jsonify({'success': False, 'error': 'Username and password required'}), 400
 
-    conn = get_db_connection()
+    # Hash before taking the writer so other writes don't wait on bcrypt
+    password_hash = hash_password(new_password)
 
-    # Check if user exists
-    user = conn.execute('SELECT id FROM users WHERE username = ?', (username,)).fetchone()
-    if not user:
-        conn.close()
-        return jsonify({'success': False, 'error': 'User not found'}), 404
+    with write_db() as conn:
+        # Check if user exists
+        user = conn.execute('SELECT id FROM users WHERE username = ?', (username,)).fetchone()
+        if not user:
+            return jsonify({'success': False, 'error': 'User not found'}), 404
+
+        # Update password
+        conn.execute('UPDATE users SET password_hash = ? WHERE username = ?',
+                    (password_hash, username))
+        conn.commit()
 
-    # Hash and update password
-    password_hash = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt())
-    conn.execute('UPDATE users SET password_hash = ? WHERE username = ?',
-                (password_hash, username))
-    conn.commit()
-    conn.close()
+    # The old password must stop working immediately
+    _login_cache.pop_values(user['id'])
 
     return jsonify({'success': True, 'message': f'Password reset for {username}'})
 
@@ -628,28 +1058,20 @@ def admin_reset_user(user_id):
     if not target_username:
         return jsonify({'success': False, 'error': 'Username required'}), 400
 
-    conn = get_db_connection()
-
-    # Check if user exists
-    user = conn.execute('SELECT id FROM users WHERE username = ?', (target_username,)).fetchone()
-    if not user:
-        conn.close()
-        return jsonify({'success': False, 'error': 'User not found'}), 404
-
-    target_user_id = user['id']
-
-    # Delete all found and unlocks records for this user
-    conn.execute('DELETE FROM found WHERE user_id = ?', (target_user_id,))
-    conn.execute('DELETE FROM unlocks WHERE user_id = ?', (target_user_id,))
+    with write_db() as conn:
+        # Check if user exists
+        user = conn.execute('SELECT id FROM users WHERE username = ?', (target_username,)).fetchone()
+        if not user:
+            return jsonify({'success': False, 'error': 'User not found'}), 404
 
-    # Reset gack_coin to 0
-    conn.execute('UPDATE users SET gack_coin = 0 WHERE id = ?', (target_user_id,))
+        target_user_id = user['id']
 
-    # Delete any active cashout tokens
-    conn.execute('DELETE FROM cashout_tokens WHERE user_id = ?', (target_user_id,))
+        # Delete found/unlocks records and cashout tokens, and reset gack_coin to 0
+        for statement in SQL_RESET_USER:
+            conn.execute(statement, (target_user_id,))
+        conn.commit()
 
-    conn.commit()
-    conn.close()
+    bump_user_version(target_user_id)
 
     return jsonify({'success': True, 'message': f'User {target_username} has been reset'})
 
@@ -662,27 +1084,23 @@ def admin_delete_user(user_id):
     if not target_username:
         return jsonify({'success': False, 'error': 'Username required'}), 400
 
-    conn = get_db_connection()
-
-    # Check if user exists
-    user = conn.execute('SELECT id FROM users WHERE username = ?', (target_username,)).fetchone()
-    if not user:
-        conn.close()
-        return jsonify({'success': False, 'error': 'User not found'}), 404
-
-    target_user_id = user['id']
+    with write_db() as conn:
+        # Check if user exists
+        user = conn.execute('SELECT id FROM users WHERE username = ?', (target_username,)).fetchone()
+        if not user:
+            return jsonify({'success': False, 'error': 'User not found'}), 404
 
-    # Delete all related records (cascading delete)
-    conn.execute('DELETE FROM found WHERE user_id = ?', (target_user_id,))
-    conn.execute('DELETE FROM unlocks WHERE user_id = ?', (target_user_id,))
-    conn.execute('DELETE FROM sessions WHERE user_id = ?', (target_user_id,))
-    conn.execute('DELETE FROM cashout_tokens WHERE user_id = ?', (target_user_id,))
+        target_user_id = user['id']
 
-    # Delete the user
-    conn.execute('DELETE FROM users WHERE id = ?', (target_user_id,))
+        # Delete all related records, then the user (cascading delete)
+        for statement in SQL_DELETE_USER:
+            conn.execute(statement, (target_user_id,))
+        conn.commit()
 
-    conn.commit()
-    conn.close()
+    # Their sessions are gone from the database, so drop any cached copies too
+    forget_user_sessions(target_user_id)
+    _login_cache.pop_values(target_user_id)
+    bump_user_version(target_user_id)
 
     return jsonify({'success': True, 'message': f'User {target_username} has been deleted'})
 
@@ -695,19 +1113,19 @@ def admin_toggle_admin(user_id):
     if not target_username:
         return jsonify({'success': False, 'error': 'Username required'}), 400
 
-    conn = get_db_connection()
+    with write_db() as conn:
+        # Check if user exists
+        user = conn.execute('SELECT id, is_admin FROM users WHERE username = ?', (target_username,)).fetchone()
+        if not user:
+            return jsonify({'success': False, 'error': 'User not found'}), 404
 
-    # Check if user exists
-    user = conn.execute('SELECT id, is_admin FROM users WHERE username = ?', (target_username,)).fetchone()
-    if not user:
-        conn.close()
-        return jsonify({'success': False, 'error': 'User not found'}), 404
+        # Toggle admin status
+        new_admin_status = 0 if user['is_admin'] else 1
+        conn.execute('UPDATE users SET is_admin = ? WHERE username = ?', (new_admin_status, target_username))
+        conn.commit()
 
-    # Toggle admin status
-    new_admin_status = 0 if user['is_admin'] else 1
-    conn.execute('UPDATE users SET is_admin = ? WHERE username = ?', (new_admin_status, target_username))
-    conn.commit()
-    conn.close()
+    # Cached sessions carry the old admin flag
+    forget_user_sessions(user['id'])
 
     action = 'promoted to admin' if new_admin_status else 'demoted to user'
     return jsonify({'success': True, 'message': f'User {target_username} {action}'})
@@ -716,46 +1134,49 @@ def admin_toggle_admin(user_id):
 @login_required
 def cashout_generate(user_id):
     """Generate a cashout QR code token for the user"""
-    conn = get_db_connection()
-
-    # Get user's current balance
-    user = conn.execute('SELECT gack_coin FROM users WHERE id = ?', (user_id,)).fetchone()
-    current_balance = user['gack_coin'] if user else 0
-
-    # Clean up expired/used tokens for this user
-    conn.execute('DELETE FROM cashout_tokens WHERE user_id = ? AND (used = 1 OR expires_at < ?)',
-                (user_id, datetime.now()))
-    conn.commit()
-
-    # Generate secure token
-    token = secrets.token_urlsafe(32)
-    expires_at = datetime.now() + timedelta(minutes=app.config['CASHOUT_TOKEN_EXPIRY_MINUTES'])
-
-    # Store token in database
-    conn.execute('INSERT INTO cashout_tokens (token, user_id, expires_at) VALUES (?, ?, ?)',
-                (token, user_id, expires_at))
-    conn.commit()
-    conn.close()
+    with write_db() as conn:
+        # Get user's current balance
+        user = conn.execute(SQL_GET_GACK_COIN, (user_id,)).fetchone()
+        current_balance = user['gack_coin'] if user else 0
+
+        # Occasionally clear out expired/used tokens; they can't be redeemed
+        # anyway, so there's no need to do it on every request
+        now = datetime.now()
+        if random.random() < app.config['CASHOUT_SWEEP_PROBABILITY']:
+            conn.execute(SQL_DELETE_STALE_CASHOUT_TOKENS, (now,))
+
+        expiry_minutes = app.config['CASHOUT_TOKEN_EXPIRY_MINUTES']
+        expires_at = now + timedelta(minutes=expiry_minutes)
+
+        # Reuse the user's live token (and its QR) with a fresh expiry if it
+        # hasn't been cashed out yet
+        cache_key = (user_id, request.host_url)
+        cached = _cashout_qr_cache.get(cache_key)
+        if cached and conn.execute(SQL_RENEW_CASHOUT_TOKEN, (expires_at, cached[0], user_id)).rowcount:
+            conn.commit()
+            token, qr_code = cached
+        else:
+            # Generate secure token
+            token = secrets.token_urlsafe(32)
 
-    # Generate QR code with full URL (uses current domain from request)
-    qr_url = request.host_url.rstrip('/') + url_for('admin_cashout', token=token)
+            # Store token in database
+            conn.execute(SQL_INSERT_CASHOUT_TOKEN, (token, user_id, expires_at))
+            conn.commit()
+            qr_code = None
 
-    # Create QR code image
-    qr = qrcode.QRCode(version=1, box_size=10, border=4)
-    qr.add_data(qr_url)
-    qr.make(fit=True)
+    if qr_code is None:
+        # Generate QR code with full URL (uses current domain from request)
+        qr_url = request.host_url.rstrip('/') + url_for('admin_cashout', token=token)
 
-    img = qr.make_image(fill_color="black", back_color="white")
+        # Create QR code as a PNG data URI for embedding in HTML (segno writes the
+        # PNG itself, no PIL image round-trip)
+        qr_code = segno.make(qr_url, error='m', boost_error=False).png_data_uri(scale=10, border=4)
 
-    # Convert to base64 for embedding in HTML
-    buffer = io.BytesIO()
-    img.save(buffer, format='PNG')
-    buffer.seek(0)
-    img_base64 = base64.b64encode(buffer.getvalue()).decode()
+    _cashout_qr_cache.set(cache_key, (token, qr_code), expiry_minutes * 60)
 
     return jsonify({
         'success': True,
-        'qr_code': f'data:image/png;base64,{img_base64}',
+        'qr_code': qr_code,
         'expires_in': app.config['CASHOUT_TOKEN_EXPIRY_MINUTES'],
         'balance': current_balance
     })
@@ -764,78 +1185,63 @@ def cashout_generate(user_id):
 @admin_required
 def admin_cashout(admin_user_id, token):
     """Admin cashout page - validate token and process cashout"""
-    conn = get_db_connection()
+    # Only a cashout POST writes; it holds the writer so the balance can't change underneath it
+    with (write_db() if request.method == 'POST' else db()) as conn:
+        # Validate token
+        token_data = conn.execute(SQL_GET_CASHOUT_TOKEN, (token,)).fetchone()
 
-    # Validate token
-    token_data = conn.execute('''
-        SELECT user_id, expires_at, used
-        FROM cashout_tokens
-        WHERE token = ?
-    ''', (token,)).fetchone()
+        if not token_data:
+            return render_template('no_access.html',
+                                 video_title='Invalid Cashout Token'), 404
 
-    if not token_data:
-        conn.close()
-        return render_template('no_access.html',
-                             video_title='Invalid Cashout Token'), 404
+        # Check if expired
+        if datetime.fromisoformat(token_data['expires_at']) < datetime.now():
+            return render_template('no_access.html',
+                                 video_title='Expired Cashout Token'), 403
 
-    # Check if expired
-    if datetime.fromisoformat(token_data['expires_at']) < datetime.now():
-        conn.close()
-        return render_template('no_access.html',
-                             video_title='Expired Cashout Token'), 403
+        # Check if already used
+        if token_data['used']:
+            return render_template('no_access.html',
+                                 video_title='Token Already Used'), 403
 
-    # Check if already used
-    if token_data['used']:
-        conn.close()
-        return render_template('no_access.html',
-                             video_title='Token Already Used'), 403
+        target_user_id = token_data['user_id']
 
-    target_user_id = token_data['user_id']
+        # Get user info
+        user = conn.execute(SQL_GET_CASHOUT_USER, (target_user_id,)).fetchone()
 
-    # Get user info
-    user = conn.execute('SELECT username, gack_coin FROM users WHERE id = ?',
-                       (target_user_id,)).fetchone()
+        if not user:
+            return render_template('no_access.html',
+                                 video_title='User Not Found'), 404
 
-    if not user:
-        conn.close()
-        return render_template('no_access.html',
-                             video_title='User Not Found'), 404
-
-    # Get admin's gack_coin
-    admin_user = conn.execute('SELECT gack_coin FROM users WHERE id = ?',
-                             (admin_user_id,)).fetchone()
-    admin_gack_coin = admin_user['gack_coin'] if admin_user else 0
-
-    if request.method == 'POST':
-        # Process cashout
-        cashout_amount = request.form.get('cashout_amount', type=int)
+        # Get admin's gack_coin
+        admin_user = current_user(admin_user_id)
+        admin_gack_coin = admin_user['gack_coin'] if admin_user else 0
 
-        if cashout_amount is None or cashout_amount < 0:
-            conn.close()
-            return jsonify({'success': False, 'error': 'Invalid cashout amount'}), 400
+        if request.method == 'POST':
+            # Process cashout
+            cashout_amount = request.form.get('cashout_amount', type=int)
 
-        if cashout_amount > user['gack_coin']:
-            conn.close()
-            return jsonify({'success': False, 'error': 'Cannot cashout more than user has'}), 400
+            if cashout_amount is None or cashout_amount < 0:
+                return jsonify({'success': False, 'error': 'Invalid cashout amount'}), 400
 
-        # Update user's gack_coin
-        new_balance = user['gack_coin'] - cashout_amount
-        conn.execute('UPDATE users SET gack_coin = ? WHERE id = ?',
-                    (new_balance, target_user_id))
+            if cashout_amount > user['gack_coin']:
+                return jsonify({'success': False, 'error': 'Cannot cashout more than user has'}), 400
 
-        # Mark token as used
-        conn.execute('UPDATE cashout_tokens SET used = 1 WHERE token = ?', (token,))
+            # Update user's gack_coin
+            new_balance = user['gack_coin'] - cashout_amount
+            conn.execute(SQL_SET_GACK_COIN, (new_balance, target_user_id))
 
-        conn.commit()
-        conn.close()
+            # Mark token as used
+            conn.execute(SQL_USE_CASHOUT_TOKEN, (token,))
 
-        return jsonify({
-            'success': True,
-            'message': f'Successfully cashed out {cashout_amount} GACKcoin',
-            'new_balance': new_balance
-        })
+            conn.commit()
+            _cashout_qr_cache.pop_if(lambda cached: cached[0] == token)
 
-    conn.close()
+            return jsonify({
+                'success': True,
+                'message': f'Successfully cashed out {cashout_amount} GACKcoin',
+                'new_balance': new_balance
+            })
 
     return render_template('cashout.html',
                          username=user['username'],
@@ -860,14 +1266,19 @@ def page_not_found(e):
 
 # Initialize database on startup
 if __name__ == '__main__':
-    # Create database if it doesn't exist
-    if not os.path.exists(app.config['DATABASE']):
-        print("Database not found, initializing...")
-        init_db()
+    # Create any missing tables; a single PRAGMA read once the schema is current
+    os.makedirs(os.path.dirname(app.config['DATABASE']) or '.', exist_ok=True)
+    init_db()
 
     # Ensure videos directory exists
     os.makedirs(app.config['VIDEO_FOLDER'], exist_ok=True)
 
-    # Run the app (HTTP only - SSL handled by reverse proxy)
+    # Exit normally on `docker stop` so atexit closes the pool and SQLite
+    # checkpoints the WAL back into database.db
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # Run the app with waitress (HTTP only - SSL handled by reverse proxy).
+    # One worker thread per pooled connection so requests never wait on the pool.
+    from waitress import serve
     print("Starting server on port 8080")
-    app.run(host='0.0.0.0', port=8080, debug=False)
+    serve(app, host='0.0.0.0', port=8080, threads=app.config['DB_POOL_SIZE'])
@@ -4,14 +4,86 @@ Database initialization script
 Run this to create a new database with sample data
 """
 import sqlite3
+import atexit
+import csv
 import bcrypt
+import os
+import re
 import sys
 
-DATABASE = 'database.db'
+# Same location as the app's DATABASE setting
+DATABASE = os.environ.get('DATABASE', 'data/database.db')
+# Same as SCAN_CODE_RE in app.py; the scanner rejects any other code, so it could never be found
+SCAN_CODE_RE = re.compile(r'[A-Za-z0-9_-]{1,64}')
+SCAN_CODE_RULE = 'letters, digits, _ and - only (max 64)'
+# Matches the app's BCRYPT_ROUNDS (same env override), so logins don't rehash CLI-created passwords
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 10))
+# bcrypt hash of the published default password 'admin', so seeding doesn't pay for a hash
+DEFAULT_ADMIN_HASH = b'$2b$10$IN.HN9YAx4XqNJUaEQUEQe/G0Li6UUJ0i5VCRn8pIhD60e2kOkIpK'
+
+_conn = None
+
+def get_connection():
+    """Connection shared by every command run in this process"""
+    global _conn
+    if _conn is None:
+        os.makedirs(os.path.dirname(DATABASE) or '.', exist_ok=True)
+        _conn = sqlite3.connect(DATABASE)
+        _conn.row_factory = sqlite3.Row
+        # Same settings as the app's connections; WAL mode persists in the database file
+        _conn.execute('PRAGMA journal_mode=WAL')
+        _conn.execute('PRAGMA synchronous=NORMAL')
+        _conn.execute('PRAGMA temp_store=MEMORY')
+        _conn.execute('PRAGMA mmap_size=268435456')
+        # Wait for the running app to finish a write instead of failing with "database is locked"
+        _conn.execute('PRAGMA busy_timeout=5000')
+        atexit.register(_conn.close)
+    return _conn
+
+def find_duplicate_scan_codes(cursor):
+    """(scan_code, 'id, id, ...') for every scan code used by more than one video"""
+    return cursor.execute('''SELECT scan_code, group_concat(id, ', ') FROM videos
+                             WHERE scan_code IS NOT NULL
+                             GROUP BY scan_code HAVING count(*) > 1''').fetchall()
+
+def create_indexes(cursor):
+    """Create lookup indexes (safe to run repeatedly)"""
+    # Scan codes are looked up on every QR scan and must be unique. Databases that
+    # gained the column through migrate_database() have no UNIQUE constraint on it,
+    # so the index enforces it; it can't be built while duplicates exist.
+    duplicates = find_duplicate_scan_codes(cursor)
+    if duplicates:
+        print("[X] These scan codes are used by more than one video:")
+        for scan_code, video_ids in duplicates:
+            print(f"  {scan_code}: video IDs {video_ids}")
+        print("Give each video its own code with edit-video, then run migrate again.")
+        sys.exit(1)
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_videos_scan_code_unique ON videos(scan_code)')
+    # Superseded by the unique index above
+    cursor.execute('DROP INDEX IF EXISTS idx_videos_scan_code')
+    # Lets session expiry checks and cleanup range-scan instead of full-scanning
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires_at)')
+    # Per-user deletes when a user is reset/deleted or generates a cashout code
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions(user_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_cashout_tokens_user ON cashout_tokens(user_id)')
+    # found/unlocks are keyed (user_id, video_id); these cover per-video lookups
+    # and the foreign key checks made when a video row changes
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_found_video ON found(video_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_unlocks_video ON unlocks(video_id)')
+
+def create_triggers(cursor):
+    """Create triggers (safe to run repeatedly)"""
+    # The app only inserts the unlock row; this awards the gack_coin in the same statement
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_unlock_award_coin AFTER INSERT ON unlocks
+        BEGIN
+            UPDATE users SET gack_coin = gack_coin + 1 WHERE id = NEW.user_id;
+        END
+    ''')
 
 def migrate_database():
     """Update existing database schema without losing data"""
-    conn = sqlite3.connect(DATABASE)
+    conn = get_connection()
     cursor = conn.cursor()
 
     print("Checking for database updates...")
@@ -79,13 +151,25 @@ def migrate_database():
         ''')
         print("[OK] Created cashout_tokens table")
 
+    # Session expiry is stored as integer unix seconds; convert older timestamp strings
+    cursor.execute("""UPDATE sessions SET expires_at = CAST(strftime('%s', expires_at, 'utc') AS INTEGER)
+                      WHERE typeof(expires_at) = 'text'""")
+    if cursor.rowcount > 0:
+        print(f"[OK] Converted {cursor.rowcount} session expiry timestamps to unix seconds")
+
+    create_indexes(cursor)
+    cursor.execute('ANALYZE')
+    print("[OK] Indexes up to date")
+
+    create_triggers(cursor)
+    print("[OK] Triggers up to date")
+
     conn.commit()
-    conn.close()
     print("Database migration complete!\n")
 
 def init_database():
     """Initialize database with tables and sample data"""
-    conn = sqlite3.connect(DATABASE)
+    conn = get_connection()
     cursor = conn.cursor()
 
     # Create users table
@@ -105,7 +189,7 @@ def init_database():
         CREATE TABLE IF NOT EXISTS sessions (
             token TEXT PRIMARY KEY,
             user_id INTEGER NOT NULL,
-            expires_at TIMESTAMP NOT NULL,
+            expires_at INTEGER NOT NULL,
             FOREIGN KEY (user_id) REFERENCES users(id)
         )
     ''')
@@ -163,15 +247,17 @@ def init_database():
         )
     ''')
 
+    create_indexes(cursor)
+    create_triggers(cursor)
+
     print("[OK] Database tables created")
 
     # Add default admin user (username: admin, password: admin)
-    password_hash = bcrypt.hashpw('admin'.encode('utf-8'), bcrypt.gensalt())
-    try:
-        cursor.execute('INSERT INTO users (username, password_hash, is_admin) VALUES (?, ?, ?)',
-                      ('admin', password_hash, 1))
+    cursor.execute('INSERT OR IGNORE INTO users (username, password_hash, is_admin) VALUES (?, ?, ?)',
+                  ('admin', DEFAULT_ADMIN_HASH, 1))
+    if cursor.rowcount:
         print("[OK] Default admin user created (username: admin, password: admin)")
-    except sqlite3.IntegrityError:
+    else:
         print("[!] Default user already exists")
 
     # Add sample videos - one for each cryptid body part
@@ -184,93 +270,136 @@ def init_database():
         ('tail.mp4', 'TAIL', 'appendage', 'Investigate the rear section', 'GACK_TAIL_6Q1W8'),
     ]
 
-    for filename, title, keyword, hint, scan_code in sample_videos:
-        try:
-            cursor.execute('INSERT INTO videos (filename, title, keyword, hint, scan_code) VALUES (?, ?, ?, ?, ?)',
-                          (filename, title, keyword, hint, scan_code))
-            print(f"[OK] Added video: {title} (scan code: {scan_code})")
-        except sqlite3.IntegrityError:
-            print(f"[!] Video already exists: {title}")
+    # One batched statement; videos whose scan code already exists are skipped
+    changes_before = conn.total_changes
+    cursor.executemany('INSERT OR IGNORE INTO videos (filename, title, keyword, hint, scan_code) VALUES (?, ?, ?, ?, ?)',
+                       sample_videos)
+    added = conn.total_changes - changes_before
+    print(f"[OK] Added {added} sample videos")
+    if added < len(sample_videos):
+        print(f"[!] {len(sample_videos) - added} sample videos already existed")
+
+    # Refresh planner statistics now that the tables have data
+    cursor.execute('ANALYZE')
 
     conn.commit()
-    conn.close()
     print("\nDatabase initialized successfully!")
     print("\nDefault credentials:")
     print("  Username: admin")
     print("  Password: admin")
     print("\nRemember to change the default password!")
 
-def add_user(username, password):
+def add_user(username, password, rounds=BCRYPT_ROUNDS):
     """Add a new user to the database"""
-    conn = sqlite3.connect(DATABASE)
+    conn = get_connection()
     cursor = conn.cursor()
 
-    password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+    password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=rounds))
 
-    try:
-        cursor.execute('INSERT INTO users (username, password_hash) VALUES (?, ?)',
-                      (username, password_hash))
-        conn.commit()
+    cursor.execute('INSERT OR IGNORE INTO users (username, password_hash) VALUES (?, ?)',
+                  (username, password_hash))
+    conn.commit()
+    if cursor.rowcount:
         print(f"[OK] User '{username}' created successfully!")
-    except sqlite3.IntegrityError:
+    else:
         print(f"[X] User '{username}' already exists!")
-    finally:
-        conn.close()
+
+def add_videos(rows):
+    """Add (filename, title, keyword, scan_code, hint) rows in one transaction; returns how many were added"""
+    conn = get_connection()
+
+    # Rows whose scan code already exists (or appears earlier in rows) are skipped. The
+    # NOT EXISTS check covers databases that haven't been migrated to the unique index yet.
+    changes_before = conn.total_changes
+    with conn:
+        conn.executemany('''INSERT OR IGNORE INTO videos (filename, title, keyword, scan_code, hint)
+                            SELECT ?1, ?2, ?3, ?4, ?5
+                            WHERE NOT EXISTS (SELECT 1 FROM videos WHERE scan_code = ?4)''',
+                         rows)
+    return conn.total_changes - changes_before
 
 def add_video(filename, title, keyword, scan_code, hint=''):
     """Add a new video to the database"""
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
+    if not SCAN_CODE_RE.fullmatch(scan_code):
+        print(f"[X] Invalid scan code '{scan_code}': {SCAN_CODE_RULE}")
+        return
 
-    try:
-        cursor.execute('INSERT INTO videos (filename, title, keyword, hint, scan_code) VALUES (?, ?, ?, ?, ?)',
-                      (filename, title, keyword, hint, scan_code))
-        conn.commit()
+    if add_videos([(filename, title, keyword, scan_code, hint)]):
         print(f"[OK] Video '{title}' added successfully!")
         print(f"  Scan code: {scan_code}")
-    except sqlite3.IntegrityError:
+    else:
         print(f"[X] Video already exists or scan code is not unique!")
-    finally:
-        conn.close()
+
+def import_videos(csv_path):
+    """Add every video listed in a CSV file (filename,title,keyword,scan_code[,hint])"""
+    rows = []
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        for line_no, row in enumerate(csv.reader(f), 1):
+            # Skip blank lines and an optional header row
+            if not row or (line_no == 1 and row[0].strip().lower() == 'filename'):
+                continue
+            if len(row) not in (4, 5):
+                print(f"[X] Line {line_no}: expected filename,title,keyword,scan_code[,hint]")
+                return
+            if not SCAN_CODE_RE.fullmatch(row[3]):
+                print(f"[X] Line {line_no}: invalid scan code '{row[3]}': {SCAN_CODE_RULE}")
+                return
+            rows.append((*row[:4], row[4] if len(row) > 4 else ''))
+
+    added = add_videos(rows)
+    print(f"[OK] Imported {added} videos from {csv_path}")
+    if added < len(rows):
+        print(f"[!] {len(rows) - added} videos skipped: scan code already in use")
 
 def add_bonus(title, keyword, scan_code, image_path, description, hint=''):
     """Add a new bonus evidence to the database"""
-    conn = sqlite3.connect(DATABASE)
+    if not SCAN_CODE_RE.fullmatch(scan_code):
+        print(f"[X] Invalid scan code '{scan_code}': {SCAN_CODE_RULE}")
+        return
+
+    conn = get_connection()
     cursor = conn.cursor()
 
-    try:
-        cursor.execute('''INSERT INTO videos
-                         (filename, title, keyword, hint, scan_code, is_bonus, image_path, description)
-                         VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-                      ('bonus.jpg', title, keyword, hint, scan_code, 1, image_path, description))
-        conn.commit()
+    # Skipped if the scan code is taken, with or without the unique index
+    cursor.execute('''INSERT OR IGNORE INTO videos
+                     (filename, title, keyword, hint, scan_code, is_bonus, image_path, description)
+                     SELECT ?1, ?2, ?3, ?4, ?5, ?6, ?7, ?8
+                     WHERE NOT EXISTS (SELECT 1 FROM videos WHERE scan_code = ?5)''',
+                  ('bonus.jpg', title, keyword, hint, scan_code, 1, image_path, description))
+    conn.commit()
+    if cursor.rowcount:
         print(f"[OK] Bonus evidence '{title}' added successfully!")
         print(f"  Scan code: {scan_code}")
         print(f"  Images: {image_path}")
         print(f"  Description: {description[:50]}..." if len(description) > 50 else f"  Description: {description}")
-    except sqlite3.IntegrityError:
+    else:
         print(f"[X] Bonus evidence already exists or scan code is not unique!")
-    finally:
-        conn.close()
 
 def edit_video(video_id, title=None, keyword=None, hint=None, scan_code=None, filename=None):
     """Edit an existing video"""
-    conn = sqlite3.connect(DATABASE)
+    # An empty scan code means "keep the current one"
+    if scan_code and not SCAN_CODE_RE.fullmatch(scan_code):
+        print(f"[X] Invalid scan code '{scan_code}': {SCAN_CODE_RULE}")
+        return
+
+    conn = get_connection()
     cursor = conn.cursor()
 
     # Get current video
-    video = cursor.execute('SELECT * FROM videos WHERE id = ?', (video_id,)).fetchone()
+    video = cursor.execute('SELECT filename, title, keyword, hint, scan_code FROM videos WHERE id = ?',
+                           (video_id,)).fetchone()
     if not video:
         print(f"[X] Video ID {video_id} not found!")
-        conn.close()
         return
+    # Named columns, since migrated databases have scan_code at the end of the table
+    old_filename, old_title, old_keyword, old_hint, old_scan_code = video
 
     # Use existing values if not provided
-    new_filename = filename if filename else video[1]
-    new_title = title if title else video[2]
-    new_keyword = keyword if keyword else video[3]
-    new_hint = hint if hint else video[4]
-    new_scan_code = scan_code if scan_code else video[5]
+    new_filename = filename if filename else old_filename
+    new_title = title if title else old_title
+    new_keyword = keyword if keyword else old_keyword
+    new_hint = hint if hint else old_hint
+    new_scan_code = scan_code if scan_code else old_scan_code
 
     try:
         cursor.execute('''UPDATE videos
@@ -284,39 +413,33 @@ def edit_video(video_id, title=None, keyword=None, hint=None, scan_code=None, fi
         print(f"  Keyword: {new_keyword}")
     except sqlite3.IntegrityError:
         print(f"[X] Update failed! Scan code must be unique.")
-    finally:
-        conn.close()
 
 def reset_password(username, new_password):
     """Reset a user's password"""
-    conn = sqlite3.connect(DATABASE)
+    conn = get_connection()
     cursor = conn.cursor()
 
     # Check if user exists
     user = cursor.execute('SELECT id FROM users WHERE username = ?', (username,)).fetchone()
     if not user:
         print(f"[X] User '{username}' not found!")
-        conn.close()
         return
 
     # Hash new password
-    password_hash = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt())
+    password_hash = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_ROUNDS))
 
     # Update password
     cursor.execute('UPDATE users SET password_hash = ? WHERE username = ?',
                    (password_hash, username))
     conn.commit()
-    conn.close()
     print(f"[OK] Password reset for user '{username}'!")
 
 def list_videos():
     """List all videos"""
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
+    conn = get_connection()
     cursor = conn.cursor()
 
     videos = cursor.execute('SELECT * FROM videos ORDER BY id').fetchall()
-    conn.close()
 
     if not videos:
         print("No videos found.")
@@ -338,12 +461,10 @@ def list_videos():
 
 def list_users():
     """List all users"""
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
+    conn = get_connection()
     cursor = conn.cursor()
 
     users = cursor.execute('SELECT id, username FROM users ORDER BY id').fetchall()
-    conn.close()
 
     if not users:
         print("No users found.")
@@ -359,9 +480,19 @@ if __name__ == '__main__':
 
         if command == 'add-user' and len(sys.argv) == 4:
             add_user(sys.argv[2], sys.argv[3])
+        elif command == 'add-user' and len(sys.argv) == 6 and sys.argv[4] == '--rounds':
+            # bcrypt only accepts costs 4-31
+            rounds = sys.argv[5]
+            if not (rounds.isdecimal() and 4 <= int(rounds) <= 31):
+                print(f"[ERROR] --rounds must be a whole number from 4 to 31, got '{rounds}'")
+                print("Usage: python init_db.py add-user <username> <password> [--rounds N]")
+                sys.exit(1)
+            add_user(sys.argv[2], sys.argv[3], int(rounds))
         elif command == 'add-video' and len(sys.argv) >= 6:
             hint = sys.argv[6] if len(sys.argv) > 6 else ''
             add_video(sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5], hint)
+        elif command == 'import-videos' and len(sys.argv) == 3:
+            import_videos(sys.argv[2])
         elif command == 'add-bonus' and len(sys.argv) >= 7:
             hint = sys.argv[7] if len(sys.argv) > 7 else ''
             add_bonus(sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5], sys.argv[6], hint)
@@ -386,8 +517,9 @@ if __name__ == '__main__':
             print("Usage:")
             print("  python init_db.py                                                     # Initialize database")
             print("  python init_db.py migrate                                             # Update database schema (keeps data)")
-            print("  python init_db.py add-user <username> <password>                     # Add a user")
+            print("  python init_db.py add-user <username> <password> [--rounds N]        # Add a user (bcrypt cost N, default 10)")
             print("  python init_db.py add-video <filename> <title> <keyword> <scan_code> [hint]  # Add a video")
+            print("  python init_db.py import-videos <csv_file>                           # Add videos listed in a CSV file")
             print("  python init_db.py add-bonus <title> <keyword> <scan_code> <image_path> <description> [hint]  # Add bonus evidence")
             print("  python init_db.py edit-video <id> [title] [keyword] [hint] [scan_code] [filename]  # Edit a video")
             print("  python init_db.py reset-password <username> <new_password>           # Reset user password")
@@ -395,6 +527,7 @@ if __name__ == '__main__':
             print("  python init_db.py list-users                                         # List all users")
             print("\nExamples:")
             print("  python init_db.py add-video head.mp4 HEAD cranium GACK_HEAD_X1Y2    # Add new video")
+            print("  python init_db.py add-user tester1 pass --rounds 4                  # Fast-to-create test account")
             print("  python init_db.py add-bonus 'Secret Clue' answer123 BONUS_001 'clue1.jpg,clue2.jpg' '<p>Solve this riddle...</p>' 'Find the hidden clue'")
             print("  python init_db.py edit-video 1 'Skull Fragment' bones               # Update title and keyword")
             print("  python init_db.py edit-video 3 '' '' 'New hint' GACK_NEW_CODE       # Update hint and scan code")
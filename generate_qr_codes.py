@@ -3,14 +3,25 @@
 Generate QR codes for all GACKfiles quests and overlay them on the hand PNG
 """
 import sqlite3
-import qrcode
-from PIL import Image, ImageDraw, ImageFilter
+import json
 import os
+import sys
+from contextlib import closing
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numpy as np
+    import segno
+    from PIL import Image
+except ImportError as e:
+    sys.exit(f"Error: {e.name} is not installed. Run: pip install -r requirements.txt")
 
 # Configuration
-DATABASE = 'app/database.db'
+DATABASE = 'app/data/database.db'
 HAND_PNG = 'app/QR/GACKfiles_QR_hand.png'
 OUTPUT_DIR = 'app/QR/generated'
+# Remembers the hand PNG analysis between runs; rebuilt whenever the PNG changes
+ANALYSIS_CACHE = 'app/QR/.hand_cache.json'
 BASE_URL = 'https://gackfiles.saltychart.net/qr/'
 
 # QR Code positioning (adjust these to fit the transparent square)
@@ -19,29 +30,29 @@ QR_SIZE = None  # Will be calculated from transparent area
 
 def get_average_colors(hand_image):
     """Extract average light and dark colors from the hand PNG"""
-    pixels = list(hand_image.getdata())
+    pixels = np.asarray(hand_image.convert('RGBA'))
+    rgb = pixels[..., :3]
 
     # Filter out transparent pixels and separate by brightness
-    light_pixels = []
-    dark_pixels = []
-
-    for pixel in pixels:
-        if len(pixel) == 4 and pixel[3] > 128:  # Not transparent
-            r, g, b, a = pixel
-            brightness = (r + g + b) / 3
-            if brightness > 128:
-                light_pixels.append((r, g, b))
-            else:
-                dark_pixels.append((r, g, b))
-
-    # Calculate averages
-    if light_pixels:
-        avg_light = tuple(sum(c) // len(light_pixels) for c in zip(*light_pixels))
+    # (average brightness > 128 is the same as channel sum > 384)
+    opaque = pixels[..., 3] > 128
+    light = rgb.sum(axis=-1, dtype=np.uint16) > 384
+    light_mask = opaque & light
+    dark_mask = opaque & ~light
+
+    # Calculate averages; masked sums read the pixels in place rather than
+    # gathering the selected ones into a copy
+    light_count = np.count_nonzero(light_mask)
+    if light_count:
+        light_sum = rgb.sum(axis=(0, 1), dtype=np.int64, where=light_mask[..., None])
+        avg_light = tuple(int(c) for c in light_sum // light_count)
     else:
         avg_light = (230, 220, 200)  # Default beige
 
-    if dark_pixels:
-        avg_dark = tuple(sum(c) // len(dark_pixels) for c in zip(*dark_pixels))
+    dark_count = np.count_nonzero(dark_mask)
+    if dark_count:
+        dark_sum = rgb.sum(axis=(0, 1), dtype=np.int64, where=dark_mask[..., None])
+        avg_dark = tuple(int(c) for c in dark_sum // dark_count)
     else:
         avg_dark = (80, 20, 20)  # Default dark red
 
@@ -50,132 +61,144 @@ def get_average_colors(hand_image):
 def find_transparent_area(hand_image):
     """Find the bounding box of the transparent square"""
     width, height = hand_image.size
-    pixels = hand_image.load()
-
-    # Find transparent region bounds
-    min_x, min_y = width, height
-    max_x, max_y = 0, 0
-
-    for y in range(height):
-        for x in range(width):
-            pixel = pixels[x, y]
-            if len(pixel) == 4 and pixel[3] < 128:  # Transparent
-                min_x = min(min_x, x)
-                min_y = min(min_y, y)
-                max_x = max(max_x, x)
-                max_y = max(max_y, y)
-
-    if min_x < max_x and min_y < max_y:
+    transparent = np.asarray(hand_image.convert('RGBA'))[..., 3] < 128
+
+    # Find transparent region bounds from the rows/columns holding any transparent pixel
+    ys = np.flatnonzero(transparent.any(axis=1))
+    xs = np.flatnonzero(transparent.any(axis=0))
+
+    if xs.size and ys.size and xs[0] < xs[-1] and ys[0] < ys[-1]:
+        min_x, max_x, min_y, max_y = int(xs[0]), int(xs[-1]), int(ys[0]), int(ys[-1])
         return (min_x, min_y, max_x - min_x, max_y - min_y)
     else:
         # Default to center if no transparent area found
         return (width // 4, height // 4, width // 2, height // 2)
 
-def add_texture_to_qr(qr_image, background_color):
-    """Add slight texture to QR code background"""
-    # Create a subtle noise texture
-    width, height = qr_image.size
-    texture = Image.new('RGBA', (width, height), background_color)
-
-    # Add very subtle random variations
-    import random
-    pixels = texture.load()
-    for y in range(height):
-        for x in range(width):
-            r, g, b = background_color
-            # Add small random variation
-            variation = random.randint(-10, 10)
-            pixels[x, y] = (
-                max(0, min(255, r + variation)),
-                max(0, min(255, g + variation)),
-                max(0, min(255, b + variation)),
-                255
-            )
-
-    return texture
-
-def generate_qr_with_overlay(scan_code, title, hand_image, light_color, dark_color, output_path):
-    """Generate a QR code and overlay it on the hand PNG"""
-    # Generate QR code
-    url = f"{BASE_URL}{scan_code}"
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_H,
-        box_size=10,
-        border=2,
-    )
-    qr.add_data(url)
-    qr.make(fit=True)
-
-    # Create QR image with custom colors
-    qr_img = qr.make_image(fill_color=dark_color, back_color=light_color)
-    qr_img = qr_img.convert('RGBA')
-
+def get_qr_placement(hand_image):
+    """Position (x, y) and size of the QR code inside the hand's transparent square"""
     # Find transparent area in hand image
     trans_x, trans_y, trans_w, trans_h = find_transparent_area(hand_image)
 
     # Resize QR to fit in transparent area (with some padding)
     padding = 20
     qr_size = min(trans_w - padding, trans_h - padding)
-    qr_img = qr_img.resize((qr_size, qr_size), Image.Resampling.LANCZOS)
-
-    # Create output image
-    result = hand_image.copy()
 
     # Center QR in transparent area
     qr_x = trans_x + (trans_w - qr_size) // 2
     qr_y = trans_y + (trans_h - qr_size) // 2
 
-    # Paste QR code
-    result.paste(qr_img, (qr_x, qr_y), qr_img)
+    return qr_x, qr_y, qr_size
+
+def generate_qr_with_overlay(scan_code, title, hand_image, placement, light_color, dark_color, output_path):
+    """Generate a QR code and overlay it on the hand PNG at placement (from get_qr_placement)
 
-    # Save result
-    result.save(output_path, 'PNG')
-    print(f"Generated: {output_path}")
+    hand_image is drawn on in place and restored before returning, so one
+    image can be reused for every QR code without copying it each time.
+    """
+    # Generate QR code
+    url = f"{BASE_URL}{scan_code}"
+    qr = segno.make_qr(url, error='h')
+
+    # Scale the module matrix (with a 2-module border) straight to the transparent
+    # area's size; nearest-neighbour keeps module edges sharp
+    qr_x, qr_y, qr_size = placement
+    modules = np.array(list(qr.matrix_iter(scale=1, border=2)), dtype=bool)
+    rows = np.arange(qr_size) * len(modules) // qr_size
+    dark = modules[np.ix_(rows, rows)]
+
+    # Create QR image with custom colors
+    pixels = np.where(dark[..., None],
+                      np.array(dark_color + (255,), dtype=np.uint8),
+                      np.array(light_color + (255,), dtype=np.uint8))
+    qr_img = Image.fromarray(pixels, 'RGBA')
+
+    # Keep the pixels the QR code will cover
+    covered = hand_image.crop((qr_x, qr_y, qr_x + qr_size, qr_y + qr_size))
+
+    # Paste QR code and save result
+    hand_image.paste(qr_img, (qr_x, qr_y))
+    try:
+        hand_image.save(output_path, 'PNG')
+    finally:
+        # Put the hand image back the way it was for the next QR code
+        hand_image.paste(covered, (qr_x, qr_y))
+    return output_path
+
+def analyze_hand_png(hand_png):
+    """Average (light, dark) colors and QR placement for the hand PNG, cached by file mtime and size"""
+    stat = os.stat(hand_png)
+    key = f"{stat.st_mtime_ns}:{stat.st_size}"
+    try:
+        with open(ANALYSIS_CACHE) as f:
+            cached = json.load(f)
+        if cached['key'] == key:
+            return tuple(cached['light']), tuple(cached['dark']), tuple(cached['placement'])
+    except (OSError, ValueError, KeyError):
+        pass
+
+    hand_image = Image.open(hand_png).convert('RGBA')
+    light_color, dark_color = get_average_colors(hand_image)
+    placement = get_qr_placement(hand_image)
+    with open(ANALYSIS_CACHE, 'w') as f:
+        json.dump({'key': key, 'light': light_color, 'dark': dark_color, 'placement': placement}, f)
+    return light_color, dark_color, placement
+
+# Each worker process loads the hand PNG once and keeps it, with the placement and
+# colors shared by every QR code, for all its jobs
+_worker_hand_image = None
+_worker_settings = None
+
+def init_worker(hand_png, placement, light_color, dark_color):
+    """Process pool initializer: load the hand PNG and shared settings for this worker"""
+    global _worker_hand_image, _worker_settings
+    _worker_hand_image = Image.open(hand_png).convert('RGBA')
+    _worker_settings = (placement, light_color, dark_color)
+
+def generate_job(job):
+    """Process pool task: job is (scan_code, title, output_path)"""
+    scan_code, title, output_path = job
+    return generate_qr_with_overlay(scan_code, title, _worker_hand_image, *_worker_settings, output_path)
 
 def main():
     # Create output directory
     os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-    # Load hand PNG
-    print(f"Loading hand PNG from: {HAND_PNG}")
-    hand_image = Image.open(HAND_PNG).convert('RGBA')
-
-    # Get colors from hand image
-    print("Analyzing hand PNG colors...")
-    light_color, dark_color = get_average_colors(hand_image)
+    # Get colors from hand image, and locate its transparent square (the same
+    # for every QR code)
+    print(f"Analyzing hand PNG: {HAND_PNG}")
+    light_color, dark_color, placement = analyze_hand_png(HAND_PNG)
     # Make the dark color much darker for better QR code visibility
     dark_color = tuple(max(0, c // 3) for c in dark_color)  # Divide by 3 to make it much darker
     print(f"Light color (QR background): RGB{light_color}")
     print(f"Dark color (QR foreground): RGB{dark_color}")
 
-    # Connect to database
+    # Get all videos; the database isn't needed once they're read
     print(f"\nConnecting to database: {DATABASE}")
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-
-    # Get all videos
-    videos = conn.execute('SELECT id, title, scan_code, is_bonus FROM videos ORDER BY id').fetchall()
-    conn.close()
+    with closing(sqlite3.connect(DATABASE)) as conn:
+        conn.row_factory = sqlite3.Row
+        videos = conn.execute('SELECT id, title, scan_code FROM videos ORDER BY id').fetchall()
 
     print(f"\nGenerating QR codes for {len(videos)} quests...\n")
+    if not videos:
+        return
 
-    # Generate QR codes
+    # Build one job per video
+    jobs = []
     for video in videos:
         # Create safe filename
         safe_title = video['title'].replace(' ', '_').replace('/', '_')
         filename = f"{video['id']:02d}_{safe_title}.png"
         output_path = os.path.join(OUTPUT_DIR, filename)
-
-        print(f"[{video['id']}] {video['title']} ({video['scan_code']})")
-        generate_qr_with_overlay(
-            video['scan_code'],
-            video['title'],
-            hand_image,
-            light_color,
-            dark_color,
-            output_path
-        )
+        jobs.append((video['scan_code'], video['title'], output_path))
+
+    # Generate QR codes in parallel; each one is independent and CPU-bound. No more
+    # workers than jobs, since each worker starts by loading the hand PNG.
+    with ProcessPoolExecutor(max_workers=min(len(jobs), os.cpu_count() or 1),
+                             initializer=init_worker,
+                             initargs=(HAND_PNG, placement, light_color, dark_color)) as executor:
+        for video, output_path in zip(videos, executor.map(generate_job, jobs)):
+            print(f"[{video['id']}] {video['title']} ({video['scan_code']})")
+            print(f"Generated: {output_path}")
 
     print(f"\n[OK] All QR codes generated in: {OUTPUT_DIR}")
 
@@ -6,8 +6,18 @@ echo   Video Quest - Quick Start Script
 echo ====================================
 echo.
 
+REM Older versions kept the database at app\database.db; move it (and its WAL) into app\data\
+if exist "app\database.db" if not exist "app\data\database.db" (
+    echo Moving app\database.db to app\data\database.db...
+    if not exist "app\data" mkdir "app\data"
+    move "app\database.db" "app\data\" >nul
+    if exist "app\database.db-wal" move "app\database.db-wal" "app\data\" >nul
+    if exist "app\database.db-shm" move "app\database.db-shm" "app\data\" >nul
+    echo.
+)
+
 REM Check if database exists
-if not exist "app\database.db" (
+if not exist "app\data\database.db" (
     echo Database not found. Initializing...
     cd app
     python init_db.py
@@ -6,8 +6,18 @@ echo "  Video Quest - Quick Start Script"
 echo "===================================="
 echo ""
 
+# Older versions kept the database at app/database.db; move it (and its WAL) into app/data/
+if [ -f "app/database.db" ] && [ ! -f "app/data/database.db" ]; then
+    echo "Moving app/database.db to app/data/database.db..."
+    mkdir -p app/data
+    for f in app/database.db app/database.db-wal app/database.db-shm; do
+        if [ -f "$f" ]; then mv "$f" app/data/; fi
+    done
+    echo ""
+fi
+
 # Check if database exists
-if [ ! -f "app/database.db" ]; then
+if [ ! -f "app/data/database.db" ]; then
     echo "Database not found. Initializing..."
     cd app
     python3 init_db.py